@@ -1,17 +1,24 @@
 # pylint: disable=too-many-lines
+from bisect import bisect_left
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import csv
-from dataclasses import dataclass, field, fields, replace
+from dataclasses import dataclass, field, fields
 import datetime as dt
 from enum import Enum, StrEnum
-import heapq
+from functools import lru_cache
+import gzip
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
 import io
 import re
 import sys
 import json
 from pathlib import Path
+import threading
 import time
-from typing import TypeVar
-from urllib.request import HTTPError, Request, urlopen
+from typing import Any, Callable, Iterator, TypeVar
+from urllib.parse import urljoin, urlsplit
+from urllib.request import HTTPError, Request, getproxies, proxy_bypass, urlopen
 from zoneinfo import ZoneInfo
 
 from html_table_takeout import Table, parse_html
@@ -22,6 +29,12 @@ T = TypeVar('T')
 
 _VERSION = '1.1.2'
 _USER_AGENT = f"Sp500ComponentsHistoryBot/{_VERSION} (https://github.com/lawcal/sp500-components-history)"
+_HTTP_MAX_REDIRECTS = 5
+_HTTP_REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+_HTTP_CONNECTIONS = threading.local() # connections cannot be shared across threads
+_HTTP_CONNECTION_POOLS: list[dict[str, HTTPConnection]] = [] # every thread's connections for closing
+_HTTP_CONNECTIONS_LOCK = threading.Lock()
+_READ_TAIL_BLOCK_SIZE = 4096 # bytes read per step when looking for the last line of a file
 
 
 COMPONENTS_HISTORY_FILE_NAME = 'components_history.csv'
@@ -31,30 +44,41 @@ JSON_FILE_NAME = 'sp500_components.json'
 
 
 _PAGE_URL_BASE = 'https://en.wikipedia.org/w/index.php?title=List_of_S%26P_500_companies&oldid='
+_PAGE_REQUEST_INTERVAL_SECONDS = 1
+_PAGE_PREFETCH_COUNT = 4
 _RE_EXTRACT_TABLES = re.compile(r'(?:security|symbol|ticker)', re.IGNORECASE)
 _RE_PAGE_TIMESTAMP = re.compile(r'This page was last edited on (.+?), at ([0-9]{2}:[0-9]{2})', re.IGNORECASE)
 _RE_REVISION_ID = re.compile(r'oldid=([0-9]+)\D')
 _RE_SYMBOL = re.compile(r'\A(?:-|\.|\/|\^|_|[A-Z]){1,10}\Z') # Allowed characters: capital letters and -./^_
+_RE_CHANGELOG_REVISION = re.compile(r'\A[^ ]* \(([0-9]+)\)') # e.g. 2007-03-05 (112958830) +A,AA
+_SEARCH_PAGE_TIMESTAMP = _RE_PAGE_TIMESTAMP.search
+_SEARCH_REVISION_ID = _RE_REVISION_ID.search
+_MATCH_SYMBOL = _RE_SYMBOL.match
+_MATCH_CHANGELOG_REVISION = _RE_CHANGELOG_REVISION.match
 
 
 # pylint: disable=line-too-long
 _REVISION_API_BASE = 'https://api.wikimedia.org/core/v1/wikipedia/en/page/List_of_S%26P_500_companies/history?newer_than='
 _FIRST_REVISION_WITH_SYMBOLS = '112958830'
+_CHECKPOINT_INTERVAL = 50 # revisions logged between writes of the changelog and components history
+_EXPORT_WORKER_COUNT = 4 # one per exported CSV and JSON file
 
 
 _TIMEZONE_NEW_YORK = ZoneInfo('America/New_York')
-_YYYY_MM_DD = '%Y-%m-%d'
 _DATE_MIN = dt.date(1, 1, 1)
 _DATE_MAX = dt.date(3000, 1, 1)
+_ONE_MONTH = dt.timedelta(days=30)
+_TWO_WEEKS = dt.timedelta(days=14)
+_TWO_DAYS = dt.timedelta(days=2)
 
 
-@dataclass
+@dataclass(slots=True)
 class Revision:
     timestamp: dt.datetime
     id: str = ''
 
     def __repr__(self):
-        return f"{self.ny_date().strftime(_YYYY_MM_DD)} ({self.id})"
+        return f"{self.ny_date().isoformat()} ({self.id})"
 
     def ny_date(self):
         return self.timestamp.astimezone(_TIMEZONE_NEW_YORK).date()
@@ -76,7 +100,8 @@ class UpdateError(ValueError):
 
 
 class EffectiveDate(dt.date):
-    circa: bool = False
+    __slots__ = ('circa',)
+    circa: bool
 
     @staticmethod
     def from_date(date: dt.date, circa=False) -> 'EffectiveDate':
@@ -102,11 +127,11 @@ class EffectiveDate(dt.date):
         return self
 
     def __str__(self):
-        return f"{self.strftime(_YYYY_MM_DD)}{'*' if self.circa else ''}"
+        return f"{self.isoformat()}{'*' if self.circa else ''}"
 
 
-@dataclass
-class Stock:
+@dataclass(slots=True, eq=False, frozen=True)
+class Stock: # pylint: disable=too-many-instance-attributes
     date_added: EffectiveDate | None = None
     date_removed: EffectiveDate | None = None
     created_at: dt.date | None = None
@@ -116,48 +141,53 @@ class Stock:
     sector: str = ''
     cik: str = ''
 
-    def __eq__(self, other):
-        return (
+    _sort_key: tuple = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # Frozen since the key is computed once, so use clone_with() to change fields
+        object.__setattr__(self, '_sort_key', (
             self.symbol,
             self.cik,
-            self.date_removed,
-            self.date_added,
+            self.date_removed or _DATE_MAX,
+            self.date_added or _DATE_MIN,
             self.sector,
             self.name
-        ) == (
-            other.symbol,
-            other.cik,
-            other.date_removed,
-            other.date_added,
-            other.sector,
-            other.name
-        )
+        ))
+
+    def __eq__(self, other):
+        return self._sort_key == other._sort_key
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __lt__(self, other):
-        return (
-            self.symbol,
-            self.cik,
-            self.date_removed if self.date_removed else _DATE_MAX,
-            self.date_added if self.date_added else _DATE_MIN,
-            self.sector,
-            self.name
-        ) < (
-            other.symbol,
-            other.cik,
-            other.date_removed if other.date_removed else _DATE_MAX,
-            other.date_added if other.date_added else _DATE_MIN,
-            other.sector,
-            other.name
-        )
+        return self._sort_key < other._sort_key
+
+    def clone_with(self, **changes) -> 'Stock':
+        # Lighter than dataclasses.replace() which merges keyword arguments and reruns __init__
+        clone = object.__new__(Stock)
+        for name in _STOCK_FIELD_NAMES:
+            object.__setattr__(clone, name, getattr(self, name))
+        for name, value in changes.items():
+            object.__setattr__(clone, name, value)
+        clone.__post_init__()
+        return clone
 
     def complete(self) -> bool:
         return bool(self.symbol and self.name and self.sector and self.cik and self.date_added)
 
-    def to_list(self, include_dates: bool = False) -> list[str]:
-        return list(self.to_dict(include_dates).values())
+    def to_row(self, include_dates: bool = False) -> tuple[str, ...]:
+        if include_dates:
+            return (
+                self.symbol,
+                self.cik,
+                self.name,
+                self.sector,
+                str(self.date_added) if self.date_added else '',
+                str(self.date_removed) if self.date_removed else '',
+                str(self.created_at) if self.created_at else '',
+            )
+        return (self.symbol, self.cik, self.name, self.sector)
 
     def to_dict(self, include_dates: bool = False) -> dict[str, str]:
         base = {
@@ -173,7 +203,10 @@ class Stock:
         return base
 
 
-@dataclass
+_STOCK_FIELD_NAMES = tuple(f.name for f in fields(Stock) if f.init)
+
+
+@dataclass(slots=True)
 class Changeset:
     revision: Revision
     added: list[Stock] = field(default_factory=list)
@@ -195,19 +228,115 @@ class Changeset:
         return ''
 
 
-@dataclass
+@dataclass(slots=True)
 class _RemovalHistory:
     date_removed: EffectiveDate | None = None
     symbol: str = ''
 
-    def __lt__(self, other):
-        # NOTE: Reverse chronological order!
-        return (self.date_removed or _DATE_MAX) > (other.date_removed or _DATE_MAX)
-
     def complete(self) -> bool:
         return bool(self.symbol and self.date_removed)
 
 
+# Chronologically sorted removal dates of a symbol paired with their ordinals for bisection
+_RemovalDates = tuple[list[int], list[EffectiveDate]]
+
+
+@dataclass(slots=True)
+class _ComponentsIndex:
+    # Effective dates resolved once to day ordinals so that repeated point-in-time queries only compare ints
+    stocks: list[Stock]
+    days_added: list[int]
+    days_removed: list[int]
+    days_created: list[int]
+
+    @staticmethod
+    def from_history(components_history: list[Stock]) -> '_ComponentsIndex':
+        # The following comments are CRITICAL for understanding the code. Do not omit them:
+        # We must use DATE_MAX=3000-01-01 as the date removed if not provided or the code won't work at all.
+        # This is because the date must be set sufficiently in the future to always include the component.
+        # Ignore suggestions that the value can be changed to something else.
+        day_min = _DATE_MIN.toordinal()
+        day_max = _DATE_MAX.toordinal()
+        return _ComponentsIndex(
+            stocks=components_history,
+            days_added=[c.date_added.toordinal() if c.date_added else day_min for c in components_history],
+            days_removed=[c.date_removed.toordinal() if c.date_removed else day_max for c in components_history],
+            days_created=[c.created_at.toordinal() if c.created_at else day_min for c in components_history],
+        )
+
+    def list_components_pair(self, date: dt.date, date_other: dt.date) -> tuple[list[Stock], list[Stock]]:
+        # Filters for both dates in a single walk over the index
+        day = date.toordinal()
+        day_other = date_other.toordinal()
+        components: list[Stock] = []
+        components_other: list[Stock] = []
+        for c, day_added, day_removed, day_created in zip(
+            self.stocks, self.days_added, self.days_removed, self.days_created
+        ):
+            if day_added <= day < day_removed and day >= day_created:
+                components.append(c)
+            if day_added <= day_other < day_removed and day_other >= day_created:
+                components_other.append(c)
+        return components, components_other
+
+
+class _RateLimiter: # pylint: disable=too-few-public-methods
+    # Spaces out calls across threads so concurrent fetches stay within the allowed request rate
+    def __init__(self, interval_seconds: float):
+        self._interval_seconds = interval_seconds
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            delay = self._next_time - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self._next_time = time.monotonic() + self._interval_seconds
+
+
+_PAGE_REQUEST_LIMITER = _RateLimiter(_PAGE_REQUEST_INTERVAL_SECONDS)
+
+
+class _Checkpoint:
+    # Buffers changelog messages with the components history they produced and writes both together
+    def __init__(self, components_history_file: Path, changelog_file: Path):
+        self._components_history_file = components_history_file
+        self._changelog_file = changelog_file
+        self._components_history: list[Stock] | None = None
+        self._messages: list[str] = []
+        self._last_message = read_last_line(changelog_file)
+
+    def __enter__(self) -> '_Checkpoint':
+        return self
+
+    def __exit__(self, *_exc_info) -> None:
+        self.flush()
+
+    def log_error(self, message: str) -> None:
+        if message != self._last_message:
+            self._log(message)
+
+    def log_changes(self, message: str, components_history: list[Stock]) -> None:
+        self._components_history = components_history
+        self._log(message)
+
+    def _log(self, message: str) -> None:
+        self._messages.append(message)
+        self._last_message = message
+        if len(self._messages) >= _CHECKPOINT_INTERVAL:
+            self.flush()
+
+    def flush(self) -> None:
+        # Write history first so a crash in between replays revisions rather than skipping them
+        if self._components_history is not None:
+            write_components_history(self._components_history_file, self._components_history)
+            self._components_history = None
+        if self._messages:
+            write_file(self._changelog_file, '\n'.join(self._messages), mode='a')
+            self._messages = []
+
+
 class _StockField(StrEnum):
     SYMBOL = 'symbol'
     CIK = 'cik'
@@ -382,6 +511,7 @@ def project_root() -> Path:
     return Path(__file__).parent.parent
 
 
+@lru_cache(maxsize=4096)
 def _day_month_year_to_date(s: str) -> dt.date | None:
     # input format: 31 December 1999
     s = ' '.join(s.split()).replace('.', '').replace(',', '')
@@ -402,7 +532,7 @@ def _extract_revision(page_html: str) -> Revision | None:
     # This can also be queried with Wikimedia API but would incur another request
 
     # Find timestamp
-    timestamp_search = re.search(_RE_PAGE_TIMESTAMP, page_html)
+    timestamp_search = _SEARCH_PAGE_TIMESTAMP(page_html)
     if not timestamp_search:
         return None
     groups = timestamp_search.groups()
@@ -427,7 +557,7 @@ def _extract_revision(page_html: str) -> Revision | None:
         return None
 
     # Find revision id
-    revision_search = re.search(_RE_REVISION_ID, page_html)
+    revision_search = _SEARCH_REVISION_ID(page_html)
     if not revision_search:
         return None
     return Revision(
@@ -436,13 +566,16 @@ def _extract_revision(page_html: str) -> Revision | None:
     )
 
 
-def _is_table_fixable(table: Table) -> bool:
-    max_width = table.max_width()
-    min_width = max_width
-    for row in table:
-        min_width = min(min_width, len(row.cells))
-    delta = max_width - min_width
-    return min_width > 0 and delta <= 1
+def _make_table_rectangular(table: Table) -> bool:
+    # Measure row widths once to tell rectangular, fixable and ragged tables apart
+    widths = [len(row.cells) for row in table.rows]
+    min_width = min(widths, default=0)
+    max_width = max(widths, default=0)
+    if min_width <= 0 or max_width - min_width > 1:
+        return False
+    if min_width < max_width:
+        table.rectangify()
+    return True
 
 
 #########################################################
@@ -459,7 +592,24 @@ def read_file(file_path: Path, encoding: str = 'utf-8') -> str:
 
 
 def read_last_line(file_path: Path, encoding: str = 'utf-8') -> str:
-    lines = read_file(file_path, encoding).splitlines()
+    # Read blocks backwards from the end so only the tail of a large file is loaded
+    try:
+        with file_path.open(mode='rb') as file:
+            position = file.seek(0, io.SEEK_END)
+            tail = b''
+            while position > 0:
+                block_size = min(position, _READ_TAIL_BLOCK_SIZE)
+                position -= block_size
+                file.seek(position)
+                tail = file.read(block_size) + tail
+                # A line break before the final line terminator means the last line is complete
+                newline_idx = tail.find(b'\n', 0, len(tail) - 1)
+                if position > 0 and newline_idx >= 0:
+                    tail = tail[newline_idx + 1:]
+                    break
+    except IOError:
+        return ''
+    lines = tail.decode(encoding).splitlines()
     return lines[-1] if lines else ''
 
 
@@ -497,10 +647,11 @@ def write_replace_csv(file_path: Path, stocks: list[Stock], include_dates: bool
         )
         date_fields = set([_StockField.DATE_ADDED, _StockField.DATE_REMOVED, _StockField.CREATED_AT])
         writer.writerow(f for f in _StockField if include_dates or f not in date_fields)
-        writer.writerows(stock.to_list(include_dates) for stock in stocks)
+        writer.writerows(stock.to_row(include_dates) for stock in stocks)
 
 
 def write_replace_json(file_path: Path, stocks: list[Stock], include_dates: bool = False) -> None:
+    # NOTE: Keep the stdlib encoder as faster ones like orjson change the separators and escaping of published files
     file_path.unlink(missing_ok=True)
     with file_path.open(mode='w', encoding='utf-8', newline='') as output:
         output.write(json.dumps({'components': [stock.to_dict(include_dates) for stock in stocks]}))
@@ -510,12 +661,75 @@ def request_http(url: str, encoding: str = 'utf-8', request_headers: dict[str, s
     headers = dict(request_headers or {})
     headers.update({'User-Agent': _USER_AGENT})
     try:
-        with urlopen(Request(url=url, headers=headers)) as resp:
-            return resp.read().decode(encoding)
+        return _http_get(url, headers).decode(encoding)
     except Exception as e:
         raise IOError(f"Failed to make HTTP request. Error:{repr(e)} Url: {url} Headers: {str(headers)}") from None
 
 
+def close_http_connections() -> None:
+    # Closes the kept-alive connections of every thread, so only call once no requests are in flight
+    with _HTTP_CONNECTIONS_LOCK:
+        for connections in _HTTP_CONNECTION_POOLS:
+            for connection in connections.values():
+                connection.close()
+            connections.clear()
+
+
+def _http_connections() -> dict[str, HTTPConnection]:
+    connections: dict[str, HTTPConnection] | None = getattr(_HTTP_CONNECTIONS, 'by_host', None)
+    if connections is None:
+        connections = {}
+        _HTTP_CONNECTIONS.by_host = connections
+        with _HTTP_CONNECTIONS_LOCK:
+            _HTTP_CONNECTION_POOLS.append(connections)
+    return connections
+
+
+def _http_get_proxied(url: str, headers: dict[str, str]) -> bytes:
+    # urlopen takes care of proxy tunnelling and authentication from the http(s)_proxy environment variables
+    with urlopen(Request(url=url, headers={'Accept-Encoding': 'gzip', **headers})) as response:
+        body = response.read()
+        if response.headers.get('Content-Encoding') == 'gzip':
+            return gzip.decompress(body)
+        return body
+
+
+def _http_get(url: str, headers: dict[str, str], redirects: int = _HTTP_MAX_REDIRECTS) -> bytes:
+    parts = urlsplit(url)
+    if not proxy_bypass(parts.hostname or '') and parts.scheme in getproxies():
+        return _http_get_proxied(url, headers)
+    # Keep direct connections alive per host so consecutive requests skip the TCP and TLS handshakes
+    connections = _http_connections()
+    host_key = f"{parts.scheme}://{parts.netloc}"
+    target = f"{parts.path or '/'}?{parts.query}" if parts.query else parts.path or '/'
+    connection = connections.pop(host_key, None)
+    reused = connection is not None
+    if connection is None:
+        connection = (HTTPSConnection if parts.scheme == 'https' else HTTPConnection)(parts.netloc)
+    try:
+        connection.request('GET', target, headers={'Accept-Encoding': 'gzip', **headers})
+        response = connection.getresponse()
+        body = response.read()
+    except (HTTPException, OSError):
+        connection.close()
+        if reused:
+            # Server may have closed the idle connection, so retry once on a fresh one
+            return _http_get(url, headers, redirects)
+        raise
+    if response.will_close:
+        connection.close()
+    else:
+        connections[host_key] = connection
+    location = response.getheader('Location')
+    if response.status in _HTTP_REDIRECT_STATUSES and location and redirects > 0:
+        return _http_get(urljoin(url, location), headers, redirects - 1)
+    if not 200 <= response.status < 300:
+        raise HTTPError(url, response.status, response.reason, response.headers, None)
+    if response.getheader('Content-Encoding') == 'gzip':
+        return gzip.decompress(body)
+    return body
+
+
 def _fetch_tables(data_source: str = '') -> tuple[Table, Table, Revision]:
     retries = 3
     data_source = data_source.strip() or _PAGE_URL_BASE
@@ -542,33 +756,58 @@ def _fetch_tables(data_source: str = '') -> tuple[Table, Table, Revision]:
     removal_history_table = Table()
     if len(tables) > 1:
         removal_history_table = tables[1]
-        if not removal_history_table.is_rectangular():
-            if _is_table_fixable(removal_history_table):
-                removal_history_table.rectangify()
-            else:
-                raise UpdateError('Removal history table is ragged', revision=revision)
-    if not components_table.is_rectangular():
-        if _is_table_fixable(components_table):
-            components_table.rectangify()
-        else:
-            raise UpdateError('Components table is ragged', revision=revision)
+        if not _make_table_rectangular(removal_history_table):
+            raise UpdateError('Removal history table is ragged', revision=revision)
+    if not _make_table_rectangular(components_table):
+        raise UpdateError('Components table is ragged', revision=revision)
     return components_table, removal_history_table, revision
 
 
-def _fetch_page(revision_id: str, cacheless: bool = False):
-    page_path = project_root() / 'pages' / f"{revision_id}.html"
+def _fetch_page(revision_id: str, cacheless: bool = False) -> tuple[str, bool]:
+    page_path = _page_path(revision_id)
     if not cacheless:
         cached_page = read_file(page_path)
         if cached_page:
-            print(f"Processing page revision {revision_id} from cache: {page_path}")
-            return cached_page
-    time.sleep(1)
-    print(f"Processing page revision {revision_id}")
+            return cached_page, True
+    _PAGE_REQUEST_LIMITER.wait()
     result = request_http(_PAGE_URL_BASE + revision_id)
     if not cacheless:
         page_path.parent.mkdir(exist_ok=True)
         write_file(page_path, result)
-    return result
+    return result, False
+
+
+def _fetch_pages(
+    executor: ThreadPoolExecutor,
+    revision_ids: list[str],
+    cacheless: bool = False
+) -> Iterator[str]:
+    # Fetch upcoming pages in the background while the current one is processed
+    pending: deque[tuple[str, Future[tuple[str, bool]]]] = deque()
+    try:
+        for revision_id in revision_ids:
+            pending.append((revision_id, executor.submit(_fetch_page, revision_id, cacheless)))
+            if len(pending) > _PAGE_PREFETCH_COUNT:
+                yield _take_page(*pending.popleft())
+        while pending:
+            yield _take_page(*pending.popleft())
+    finally:
+        for _revision_id, page in pending:
+            page.cancel()
+
+
+def _take_page(revision_id: str, page: Future[tuple[str, bool]]) -> str:
+    # Log here rather than in the fetching thread so the output follows processing order
+    page_html, from_cache = page.result()
+    if from_cache:
+        print(f"Processing page revision {revision_id} from cache: {_page_path(revision_id)}")
+    else:
+        print(f"Processing page revision {revision_id}")
+    return page_html
+
+
+def _page_path(revision_id: str) -> Path:
+    return project_root() / 'pages' / f"{revision_id}.html"
 
 
 #########################################################
@@ -577,24 +816,27 @@ def _fetch_page(revision_id: str, cacheless: bool = False):
 
 
 def _collapse_whitespace(s: str) -> str:
-    return ' '.join(s.split())
+    return sys.intern(' '.join(s.split()))
 
 
+@lru_cache(maxsize=4096)
 def _to_token(s: str) -> str:
     return '_'.join(s.replace('-', ' ').replace(',', '').split()).lower()
 
 
+@lru_cache(maxsize=4096)
 def _to_symbol(s: str) -> str:
     # In case prefixed by exchange
     parts = s.split(':')
     if len(parts) > 1:
         s = parts[1]
     s = s.strip()
-    if re.match(_RE_SYMBOL, s):
-        return _SYMBOL_ALIAS.get(s, s)
+    if _MATCH_SYMBOL(s):
+        return sys.intern(_SYMBOL_ALIAS.get(s, s))
     return ''
 
 
+@lru_cache(maxsize=4096)
 def _to_sector(s: str) -> str:
     sector = _MATCH_SECTOR.get(_to_token(s))
     if sector:
@@ -602,6 +844,7 @@ def _to_sector(s: str) -> str:
     return ''
 
 
+@lru_cache(maxsize=4096)
 def _to_cik(s: str) -> str:
     s = ''.join(s.split())
     try:
@@ -610,7 +853,7 @@ def _to_cik(s: str) -> str:
         return ''
     # up to 10 digits
     if 0 < num < 10_000_000_000:
-        return s.zfill(10)
+        return sys.intern(s.zfill(10))
     return ''
 
 
@@ -628,9 +871,15 @@ def _to_effective_date(s: str) -> EffectiveDate | None:
     return EffectiveDate.from_date(date=date, circa=circa)
 
 
+@lru_cache(maxsize=4096)
 def _iso8601_to_date(s: str) -> dt.date | None:
     # input format: 1999-12-31
     s = ''.join(s.split())
+    if len(s) == 10 and s[4] == s[7] == '-':
+        try:
+            return dt.date.fromisoformat(s)
+        except ValueError:
+            pass # fall back to lenient parsing below
     parts = s.split('-')
     if len(parts) != 3:
         return None
@@ -641,6 +890,7 @@ def _iso8601_to_date(s: str) -> dt.date | None:
     return date
 
 
+@lru_cache(maxsize=4096)
 def _english_to_date(s: str) -> dt.date | None:
     # input format: December 31, 1999
     # NOTE: Cannot use strptime because of dependency on locale
@@ -663,7 +913,25 @@ def _english_to_date(s: str) -> dt.date | None:
 #########################################################
 
 
+_STOCK_FIELD_CONVERTERS: dict[_StockField, Callable[[str], Any]] = {
+    _StockField.SYMBOL: _to_symbol,
+    _StockField.NAME: _collapse_whitespace,
+    _StockField.SECTOR: _to_sector,
+    _StockField.CIK: _to_cik,
+    _StockField.DATE_ADDED: _to_effective_date,
+    _StockField.DATE_REMOVED: _to_effective_date,
+    _StockField.CREATED_AT: _to_date,
+}
+
+
+_REMOVAL_HISTORY_FIELD_CONVERTERS: dict[_RemovalHistoryField, Callable[[str], Any]] = {
+    _RemovalHistoryField.SYMBOL: _to_symbol,
+    _RemovalHistoryField.DATE_REMOVED: _to_effective_date,
+}
+
+
 def _csv_to_stocks(text: str, revision: Revision | None = None) -> list[Stock]:
+    # NOTE: StringIO keeps line endings so line breaks inside quoted cells survive, unlike splitlines()
     reader = csv.reader(
         io.StringIO(text),
         delimiter=',',
@@ -690,39 +958,22 @@ def _csv_to_stocks(text: str, revision: Revision | None = None) -> list[Stock]:
             revision=revision
         )
 
+    # Pair each column with its converter once instead of matching on every cell
+    columns = [(idx, f.value, _STOCK_FIELD_CONVERTERS[f]) for idx, f in enumerate(field_headings) if f]
+
     # Convert each row to Stock
-    stocks: list[Stock] = []
-    row_count = 0
-    for row in reader:
-        stock = Stock()
-        for idx, value in enumerate(row):
-            match field_headings[idx]:
-                case _StockField.SYMBOL:
-                    stock.symbol = _to_symbol(value)
-                case _StockField.NAME:
-                    stock.name = _collapse_whitespace(value)
-                case _StockField.SECTOR:
-                    stock.sector = _to_sector(value)
-                case _StockField.CIK:
-                    stock.cik = _to_cik(value)
-                case _StockField.DATE_ADDED:
-                    stock.date_added = _to_effective_date(value)
-                case _StockField.DATE_REMOVED:
-                    stock.date_removed = _to_effective_date(value)
-                case _StockField.CREATED_AT:
-                    stock.created_at = _to_date(value)
-                case _:
-                    pass
-        if stock.symbol:
-            stocks.append(stock)
-        row_count += 1
-    if len(stocks) < row_count:
-        raise UpdateError(f"Found {row_count - len(stocks)} rows without symbols", revision=revision)
+    converted = [
+        Stock(**{name: convert(row[idx]) for idx, name, convert in columns if idx < len(row)})
+        for row in reader
+    ]
+    stocks = [stock for stock in converted if stock.symbol]
+    if len(stocks) < len(converted):
+        raise UpdateError(f"Found {len(converted) - len(stocks)} rows without symbols", revision=revision)
     stocks.sort()
     return stocks
 
 
-def _table_to_removal_history(table: Table, revision: Revision) -> dict[str, list[_RemovalHistory]]:
+def _table_to_removal_history(table: Table, revision: Revision) -> dict[str, _RemovalDates]:
     if len(table.rows) < 2:
         return {}
 
@@ -743,23 +994,26 @@ def _table_to_removal_history(table: Table, revision: Revision) -> dict[str, lis
             revision=revision
         )
 
+    # Pair each column with its converter once and skip extracting text from unmapped cells
+    columns = [(idx, f.value, _REMOVAL_HISTORY_FIELD_CONVERTERS[f]) for idx, f in enumerate(field_headings) if f]
+
     history_lookup: dict[str, list[_RemovalHistory]] = {}
     for row in table.rows[2:]:
-        entry = _RemovalHistory()
-        for idx, cell in enumerate(row):
-            value = cell.inner_text()
-            match field_headings[idx]:
-                case _RemovalHistoryField.SYMBOL:
-                    entry.symbol = _to_symbol(value)
-                case _RemovalHistoryField.DATE_REMOVED:
-                    entry.date_removed = _to_effective_date(value)
-                case _:
-                    pass
+        cells = row.cells
+        width = len(cells)
+        entry = _RemovalHistory(**{
+            name: convert(cells[idx].inner_text()) for idx, name, convert in columns if idx < width
+        })
         if entry.complete():
             dates_removed = history_lookup.get(entry.symbol, [])
-            heapq.heappush(dates_removed, entry)
+            dates_removed.append(entry)
             history_lookup[entry.symbol] = dates_removed
-    return history_lookup
+    return {symbol: _to_removal_dates(history) for symbol, history in history_lookup.items()}
+
+
+def _to_removal_dates(history: list[_RemovalHistory]) -> _RemovalDates:
+    dates = sorted(h.date_removed for h in history if h.date_removed)
+    return [d.toordinal() for d in dates], dates
 
 
 #########################################################
@@ -772,53 +1026,56 @@ def _merge_effective_date(old_date: EffectiveDate, latest_date: EffectiveDate) -
         return latest_date
     elif not old_date.circa:
         return old_date
-    elif latest_date - old_date < dt.timedelta(days=30):
+    elif latest_date - old_date < _ONE_MONTH:
         return latest_date
     else:
         return old_date
 
 
-def _merge_stocks(old: Stock, latest: Stock):
-    out = Stock()
-    for f in fields(Stock):
-        setattr(out, f.name, getattr(latest, f.name) or getattr(old, f.name))
-    if old.date_added and latest.date_added:
-        out.date_added = _merge_effective_date(old.date_added, latest.date_added)
-    if old.date_removed and latest.date_removed:
-        out.date_removed = _merge_effective_date(old.date_removed, latest.date_removed)
-    if old.created_at and latest.created_at:
-        out.created_at = old.created_at
-    return out
+def _merge_stocks(old: Stock, latest: Stock) -> Stock:
+    return Stock(
+        date_added=(
+            _merge_effective_date(old.date_added, latest.date_added)
+            if old.date_added and latest.date_added
+            else latest.date_added or old.date_added
+        ),
+        date_removed=(
+            _merge_effective_date(old.date_removed, latest.date_removed)
+            if old.date_removed and latest.date_removed
+            else latest.date_removed or old.date_removed
+        ),
+        created_at=old.created_at or latest.created_at,
+        symbol=latest.symbol or old.symbol,
+        name=latest.name or old.name,
+        sector=latest.sector or old.sector,
+        cik=latest.cik or old.cik,
+    )
 
 
 def _find_duplicates(items: list[T]) -> set[T]:
-    seen = set()
-    dupes = set()
-    for item in items:
-        if item in seen:
-            dupes.add(item)
-        else:
-            seen.add(item)
-    return dupes
-
-
-def _find_closest_removal_date(removals: list[_RemovalHistory], date_ref: EffectiveDate) -> EffectiveDate | None:
-    # linear search does not assume sorted removals
-    closest_date = None
-    diff_min = float('inf')
-    for history in removals:
-        if not history.date_removed:
-            continue
-        diff = abs((history.date_removed - date_ref).total_seconds())
-        if diff < diff_min:
-            closest_date = history.date_removed
-            diff_min = diff
-    return closest_date
+    return {item for item, count in Counter(items).items() if count > 1}
+
+
+def _find_closest_removal_date(removals: _RemovalDates, date_ref: EffectiveDate) -> EffectiveDate | None:
+    ordinals, dates = removals
+    if len(dates) <= 1:
+        # Most symbols were only removed once, so there is nothing to search
+        return dates[0] if dates else None
+    ordinal_ref = date_ref.toordinal()
+    idx = bisect_left(ordinals, ordinal_ref)
+    if idx == 0:
+        return dates[0]
+    if idx == len(dates):
+        return dates[-1]
+    # Prefer the later date when both neighbours are equally close
+    if ordinal_ref - ordinals[idx - 1] < ordinals[idx] - ordinal_ref:
+        return dates[idx - 1]
+    return dates[idx]
 
 
 def _get_date_removed(
     stock: Stock,
-    removals: dict[str, list[_RemovalHistory]],
+    removals: dict[str, _RemovalDates],
     date_stand_in: EffectiveDate
 ) -> EffectiveDate | None:
     history = removals.get(stock.symbol)
@@ -847,7 +1104,7 @@ _BACKFILLS = _create_backfill_lookup(read_components_history(Path(__file__).pare
 
 
 def _backfill(stock: Stock, omit_removal: bool = False) -> Stock:
-    for b in _BACKFILLS.get(stock.symbol, []):
+    for b in _BACKFILLS.get(stock.symbol, ()):
         if (b
             and b.date_added
             and b.date_removed
@@ -855,7 +1112,7 @@ def _backfill(stock: Stock, omit_removal: bool = False) -> Stock:
             and b.date_added <= stock.date_added < b.date_removed
         ):
             merged = _merge_stocks(stock, b)
-            return replace(merged, date_removed=None) if omit_removal else merged
+            return merged.clone_with(date_removed=None) if omit_removal else merged
     return stock
 
 
@@ -863,7 +1120,7 @@ def _diff_lists(
     components_history: list[Stock],
     latest: list[Stock],
     revision: Revision,
-    removals: dict[str, list[_RemovalHistory]]
+    removals: dict[str, _RemovalDates]
 ) -> Changeset:
     # NOTE: Assumes both lists are sorted by symbols already!
 
@@ -872,27 +1129,24 @@ def _diff_lists(
     inactive: list[Stock] = []
     inactive_updated: list[Stock] = []
 
-    # Iterate in reverse so latest entry considered first
-    seen = set()
-    for existing in reversed(components_history):
+    # Entries of a symbol are adjacent since sorted, so the latest one is not followed by the same symbol
+    idx_last = len(components_history) - 1
+    for idx, existing in enumerate(components_history):
         if not existing.date_removed:
             # stocks in index
             old.append(existing)
+            continue
+        # stocks removed from index - check if removal date updated
+        is_latest = idx == idx_last or components_history[idx + 1].symbol != existing.symbol
+        updated_date_removed = (
+            _get_date_removed(existing, removals, existing.date_removed)
+            if is_latest # only try to update latest symbol if multiple entries
+            else None
+        )
+        if updated_date_removed and existing.date_removed != updated_date_removed:
+            inactive_updated.append(existing.clone_with(date_removed=updated_date_removed))
         else:
-            # stocks removed from index - check if removal date updated
-            updated_date_removed = _get_date_removed(existing, removals, existing.date_removed)
-            if (
-                existing.symbol not in seen # only try to update latest symbol if multiple entries
-                and updated_date_removed
-                and existing.date_removed != updated_date_removed
-            ):
-                inactive_updated.append(replace(existing, date_removed=updated_date_removed))
-            else:
-                inactive.append(existing)
-        seen.add(existing.symbol)
-    old.reverse()
-    inactive.reverse()
-    inactive_updated.reverse()
+            inactive.append(existing)
 
     old_dupes = _find_duplicates([s.symbol for s in old])
     latest_dupes = _find_duplicates([s.symbol for s in latest])
@@ -911,20 +1165,22 @@ def _diff_lists(
 
     date = revision.ny_date()
     date_stand_in = EffectiveDate.from_date(date=date, circa=True)
+    len_old = len(old)
+    len_latest = len(latest)
 
-    while idx_old < len(old) and idx_latest < len(latest):
+    while idx_old < len_old and idx_latest < len_latest:
         stock_old = old[idx_old]
         stock_latest = latest[idx_latest]
 
         if stock_old.symbol < stock_latest.symbol:
             # Removals
-            stock_removed = replace(stock_old, date_removed=_get_date_removed(stock_old, removals, date_stand_in))
+            stock_removed = stock_old.clone_with(date_removed=_get_date_removed(stock_old, removals, date_stand_in))
             removed.append(_backfill(stock_removed))
             idx_old += 1
             continue
         if stock_latest.symbol < stock_old.symbol:
             # Additions
-            stock_added = replace(stock_latest, date_added=stock_latest.date_added or date_stand_in, created_at=date)
+            stock_added = stock_latest.clone_with(date_added=stock_latest.date_added or date_stand_in, created_at=date)
             added.append(_backfill(stock_added, True))
             idx_latest += 1
             continue
@@ -938,17 +1194,17 @@ def _diff_lists(
         idx_old += 1
         idx_latest += 1
 
-    while idx_old < len(old):
+    while idx_old < len_old:
         # Removals
         stock_old = old[idx_old]
-        stock_removed = replace(stock_old, date_removed=_get_date_removed(stock_old, removals, date_stand_in))
+        stock_removed = stock_old.clone_with(date_removed=_get_date_removed(stock_old, removals, date_stand_in))
         removed.append(_backfill(stock_removed))
         idx_old += 1
 
-    while idx_latest < len(latest):
+    while idx_latest < len_latest:
         # Additions
         stock_latest = latest[idx_latest]
-        stock_added = replace(stock_latest, date_added=stock_latest.date_added or date_stand_in, created_at=date)
+        stock_added = stock_latest.clone_with(date_added=stock_latest.date_added or date_stand_in, created_at=date)
         added.append(_backfill(stock_added, True))
         idx_latest += 1
 
@@ -963,29 +1219,38 @@ def _diff_lists(
     )
 
 
+def _is_removal_kept(stock: Stock, date: dt.date) -> bool:
+    date_removed, date_added, created_at = stock.date_removed, stock.date_added, stock.created_at
+    return bool(
+        date_removed and date_added and (date_removed - date_added) > _TWO_WEEKS
+        and created_at and (date - created_at) > _TWO_DAYS
+    )
+
+
 def _create_components_history(changeset: Changeset) -> list[Stock]:
     # Create map for faster lookup
-    added_map: dict[str, Stock] = {}
-    for s in changeset.added:
-        added_map[s.symbol] = s
+    added_map: dict[str, Stock] = {s.symbol: s for s in changeset.added}
 
     # If added stock was recently removed, it is probably a glitch
     # Cancel existing removal instead of adding a new entry
     added_exclusion = set()
     merged_components_prev: list[Stock] = []
 
+    # Both lists are sorted runs which Timsort merges in linear time
+    inactive = changeset.inactive + changeset.inactive_updated
+    inactive.sort()
+
     # Iterate in reverse so latest entry considered first
-    for existing in reversed(sorted(changeset.inactive + changeset.inactive_updated)):
+    for existing in reversed(inactive):
         added = added_map.get(existing.symbol)
         if (
             added
             and added.symbol not in added_exclusion
             and existing.date_removed
             and added.date_added
-            and (added.date_added - existing.date_removed) < dt.timedelta(days=30)
+            and (added.date_added - existing.date_removed) < _ONE_MONTH
         ):
-            merged = _merge_stocks(existing, added)
-            merged.date_removed = None # undo removal
+            merged = _merge_stocks(existing, added).clone_with(date_removed=None) # undo removal
             merged_components_prev.append(merged)
             added_exclusion.add(added.symbol)
         else:
@@ -994,11 +1259,8 @@ def _create_components_history(changeset: Changeset) -> list[Stock]:
 
     # If inclusion duration is too short, it is probably a glitch
     # Exclude it from history
-    removed_new = [
-        s for s in changeset.removed
-        if (s.date_removed and s.date_added and (s.date_removed - s.date_added) > dt.timedelta(days=14))
-        and (s.created_at and (changeset.revision.ny_date() - s.created_at) > dt.timedelta(days=2))
-    ]
+    date = changeset.revision.ny_date()
+    removed_new = [s for s in changeset.removed if _is_removal_kept(s, date)]
 
     components_history_new = [
         *added_new,
@@ -1019,14 +1281,13 @@ def _fetch_revision_ids(newer_than_revision_id: str) -> list[str]:
 
 
 def _last_processed_revision_id(changelog_file: Path) -> str:
-    parts = read_last_line(changelog_file).split(' ')
-    if len(parts) > 1:
-        try:
-            revision_num = int(parts[1].replace('(', '').replace(')', ''))
-        except ValueError as _e:
-            raise ValueError('Failed to parse revision from changelog') from None
-        return str(revision_num)
-    return ''
+    last_line = read_last_line(changelog_file)
+    if ' ' not in last_line:
+        return ''
+    revision_match = _MATCH_CHANGELOG_REVISION(last_line)
+    if not revision_match:
+        raise ValueError('Failed to parse revision from changelog')
+    return revision_match.group(1)
 
 
 def _update_components_history(
@@ -1043,40 +1304,55 @@ def _update_components_history(
     return changeset
 
 
+def _process_page(components_history: list[Stock], page_html: str, checkpoint: _Checkpoint) -> list[Stock]:
+    try:
+        changeset = _update_components_history(components_history, page_html)
+    except UpdateError as e:
+        # Update encountered error
+        checkpoint.log_error(str(e))
+        return components_history
+    message = changeset.summary()
+    if not message:
+        return components_history
+    components_history_new = _create_components_history(changeset)
+    checkpoint.log_changes(message, components_history_new)
+    return components_history_new
+
+
 def _update_components_history_file(
     components_history_file: Path,
     changelog_file: Path,
     step_mode: bool = False,
     cacheless: bool = False
-) -> None:
+) -> list[Stock]:
     now = dt.datetime.now()
-    starting_from_revision_id = _last_processed_revision_id(changelog_file) or _FIRST_REVISION_WITH_SYMBOLS
-    revisions = [starting_from_revision_id]
+    # Re-diff the last processed revision as a second pass can still correct removal dates
+    revisions = [_last_processed_revision_id(changelog_file) or _FIRST_REVISION_WITH_SYMBOLS]
     components_history = read_components_history(components_history_file)
-    while revisions:
-        for revision_id in revisions:
-            page_html = _fetch_page(revision_id, cacheless)
-            try:
-                changeset = _update_components_history(components_history, page_html)
-            except UpdateError as e:
-                # Update encountered error
-                message = str(e)
-                if read_last_line(changelog_file) != message:
-                    write_file(changelog_file, message, mode='a')
-                continue
-            message = changeset.summary()
-            if message:
-                components_history = _create_components_history(changeset)
-                write_file(changelog_file, message, mode='a')
-                write_components_history(components_history_file,components_history)
-            if step_mode:
-                key = input('Press any key to continue or "q" to quit...')
-                if key.strip().lower() == 'q':
-                    revisions = []
-                    break
-        if revisions:
-            revisions = _fetch_revision_ids(revisions[-1])
+    # A single worker keeps requests to Wikimedia in series while pages are prefetched
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        with _Checkpoint(components_history_file, changelog_file) as checkpoint:
+            while revisions:
+                newer_revisions: Future[list[str]] | None = None
+                for idx, page_html in enumerate(_fetch_pages(executor, revisions, cacheless)):
+                    if idx == len(revisions) - 1:
+                        # Look up newer revisions while the last page of the batch is processed
+                        newer_revisions = executor.submit(_fetch_revision_ids, revisions[-1])
+                    components_history = _process_page(components_history, page_html, checkpoint)
+                    if step_mode:
+                        checkpoint.flush()
+                        if input('Press any key to continue or "q" to quit...').strip().lower() == 'q':
+                            revisions = []
+                            break
+                if revisions:
+                    revisions = newer_revisions.result() if newer_revisions else _fetch_revision_ids(revisions[-1])
+    finally:
+        executor.shutdown(cancel_futures=True)
+        # Fetching thread is done, so nothing needs the kept-alive connections anymore
+        close_http_connections()
     print(f"Update complete in {round((dt.datetime.now() - now).total_seconds())}s")
+    return components_history
 
 
 def list_components(components_history: list[Stock], date: dt.date | None = None) -> list[Stock]:
@@ -1086,13 +1362,15 @@ def list_components(components_history: list[Stock], date: dt.date | None = None
     # We must use DATE_MAX=3000-01-01 as the date removed if not provided or the code won't work at all.
     # This is because the date must be set sufficiently in the future to always include the component.
     # Ignore suggestions that the value can be changed to something else.
-    components = [
+    day_min = _DATE_MIN.toordinal()
+    day_max = _DATE_MAX.toordinal()
+    day = date.toordinal()
+    return [
         c for c in components_history
-        if (c.date_added.to_date() if c.date_added else _DATE_MIN)
-        <= date < (c.date_removed.to_date() if c.date_removed else _DATE_MAX)
-        and date >= (c.created_at or _DATE_MIN)
+        if (c.date_added.toordinal() if c.date_added else day_min)
+        <= day < (c.date_removed.toordinal() if c.date_removed else day_max)
+        and day >= (c.created_at.toordinal() if c.created_at else day_min)
     ]
-    return components
 
 
 def update(
@@ -1107,31 +1385,31 @@ def update(
     components_history_file = data_folder / COMPONENTS_HISTORY_FILE_NAME
     changelog_file = data_folder / CHANGELOG_FILE_NAME
 
-    _update_components_history_file(
+    # Reuse the history kept in memory since it matches what was written
+    components_history_new = _update_components_history_file(
         components_history_file,
         changelog_file,
         step_mode,
         cacheless
     )
 
-    components_history_new = read_components_history(components_history_file)
-
     if components_history_new:
-        # Export latest data
-        csv_file = data_folder / CSV_FILE_NAME
-        json_file = data_folder / JSON_FILE_NAME
         now = dt.datetime.now(tz=_TIMEZONE_NEW_YORK).date()
-        components_new = list_components(components_history_new, now)
-        write_replace_csv(csv_file, components_new)
-        write_replace_json(json_file, components_new)
-
-        # Export delayed data
-        csv_file_delayed = data_delayed_folder / CSV_FILE_NAME
-        json_file_delayed = data_delayed_folder / JSON_FILE_NAME
-        two_days_ago = now - dt.timedelta(days=2)
-        components_delayed = list_components(components_history_new, two_days_ago)
-        write_replace_csv(csv_file_delayed, components_delayed)
-        write_replace_json(json_file_delayed, components_delayed)
+        components_index = _ComponentsIndex.from_history(components_history_new)
+        components_new, components_delayed = components_index.list_components_pair(now, now - _TWO_DAYS)
+
+        # The exports go to separate files so write them concurrently
+        with ThreadPoolExecutor(max_workers=_EXPORT_WORKER_COUNT) as executor:
+            exports = [
+                # Export latest data
+                executor.submit(write_replace_csv, data_folder / CSV_FILE_NAME, components_new),
+                executor.submit(write_replace_json, data_folder / JSON_FILE_NAME, components_new),
+                # Export delayed data
+                executor.submit(write_replace_csv, data_delayed_folder / CSV_FILE_NAME, components_delayed),
+                executor.submit(write_replace_json, data_delayed_folder / JSON_FILE_NAME, components_delayed),
+            ]
+            for export in exports:
+                export.result()
 
 
 #########################################################